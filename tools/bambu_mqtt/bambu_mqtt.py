@@ -1,14 +1,105 @@
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
-from cryptography.x509.oid import NameOID
-from typing import Callable, Optional, List, Dict
+from typing import Callable, Iterator, Optional, List, Dict, Tuple, Union
 import paho.mqtt.client as mqtt
+import asyncio
+import logging
+import socket
 import ssl
-import json
-import queue
+import threading
 import time
 import os
 
+logger = logging.getLogger("bambu.mqtt")
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(obj: object) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+# Serial numbers (certificate CN) of printers we already probed, keyed by (host, port).
+SERIAL_NUMBER_CACHE_TTL = 5 * 60
+_SERIAL_NUMBER_CACHE: Dict[Tuple[str, int], Tuple[str, float]] = {}
+_SERIAL_NUMBER_CACHE_LOCK = threading.Lock()
+
+# Delay between reconnection attempts while a printer is unreachable, in seconds
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+# Shared by all clients so the CA is only loaded once and OpenSSL can reuse its caches.
+_MQTT_SSL_CONTEXT = ssl.create_default_context(
+    cafile=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ca_cert.pem")
+)
+_MQTT_SSL_CONTEXT.verify_flags &= ~ssl.VERIFY_X509_STRICT
+_MQTT_SSL_CONTEXT.check_hostname = False
+_MQTT_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+# Pre-serialized fixed shape requests, only the sequence id (and G-code) need to be filled.
+_GCODE_LINE_REQUEST = b'{"print":{"sequence_id":"%d","command":"gcode_line","param":%b,"user_id":"0"}}'
+_STOP_REQUEST = b'{"print":{"sequence_id":"%d","command":"stop","param":""}}'
+_PAUSE_REQUEST = b'{"print":{"sequence_id":"%d","command":"pause","param":""}}'
+_RESUME_REQUEST = b'{"print":{"sequence_id":"%d","command":"resume","param":""}}'
+
+
+# DER encoding of the commonName OID (2.5.4.3)
+_COMMON_NAME_OID = b"\x55\x04\x03"
+
+
+def _der_read(data: bytes, offset: int) -> Tuple[int, int, int]:
+    """Read the DER element at offset, returns its tag and the bounds of its value."""
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+
+    if length & 0x80:
+        length_size = length & 0x7F
+        length = int.from_bytes(data[offset : offset + length_size], "big")
+        offset += length_size
+
+    return (tag, offset, offset + length)
+
+
+def _der_iter(data: bytes, start: int, end: int) -> Iterator[Tuple[int, int, int]]:
+    while start < end:
+        element = _der_read(data, start)
+        yield element
+        start = element[2]
+
+
+def get_certificate_common_name(der_cert: bytes) -> Optional[str]:
+    """Extract the subject CN of a DER encoded X.509 certificate."""
+    _, cert_start, cert_end = _der_read(der_cert, 0)
+    _, tbs_start, tbs_end = _der_read(der_cert, cert_start)
+    tbs_fields = list(_der_iter(der_cert, tbs_start, tbs_end))
+
+    # Skip the optional version, then we have serialNumber, signature, issuer, validity and subject.
+    if tbs_fields[0][0] == 0xA0:
+        tbs_fields = tbs_fields[1:]
+
+    _, subject_start, subject_end = tbs_fields[4]
+
+    for _, rdn_start, rdn_end in _der_iter(der_cert, subject_start, subject_end):
+        for _, attr_start, attr_end in _der_iter(der_cert, rdn_start, rdn_end):
+            attr_type, attr_value = list(_der_iter(der_cert, attr_start, attr_end))[:2]
+
+            if der_cert[attr_type[1] : attr_type[2]] == _COMMON_NAME_OID:
+                return der_cert[attr_value[1] : attr_value[2]].decode("utf-8")
+
+    return None
+
 
 # From https://github.com/Doridian/OpenBambuAPI/blob/920f7d580889092a4bef02dfe02e0cc3123cc0ce/examples/mqtt.py
 class MQTTSClient(mqtt.Client):
@@ -38,37 +129,73 @@ class BambuMQTT(object):
     pwd: str
     serial_number: Optional[str]
     is_connecting: bool
-    conn_state: queue.Queue
-    internal_queue: queue.Queue
+    is_disconnecting: bool
+    loop: Optional[asyncio.AbstractEventLoop]
+    misc_task: Optional[asyncio.Task]
+    pending_connect: Optional[asyncio.Future]
+    conn_state: Optional[asyncio.Future]
+    disconnected: Optional[asyncio.Future]
+    pending_replies: Dict[str, asyncio.Future]
+    json_parser: Optional["simdjson.Parser"]
     debug: bool
 
     push_status_update_callback: Optional[Callable[Dict[str, object], object]]
     push_status_update_userdata: Optional[object]
     sequence_id: int
 
-    def __init__(self, host: str, port: int, user: str, pwd: str, debug: bool = False):
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        user: str,
+        pwd: str,
+        debug: bool = False,
+        serial_number: Optional[str] = None,
+    ):
         self.host = host
         self.port = port
         self.user = user
         self.pwd = pwd
         self.debug = debug
-        self.is_connecting = False
-        self.conn_state = queue.Queue(maxsize=1)
-        self.internal_queue = queue.Queue()
 
-        ssl_context = ssl.create_default_context(cafile="ca_cert.pem")
-        ssl_context.verify_flags &= ~ssl.VERIFY_X509_STRICT
+        # The logger is shared by all instances, only make it more verbose and leave the rest to the application.
+        if self.debug:
+            logger.setLevel(logging.DEBUG)
 
-        # We grab the device_id from the cert, should be fine (as we use the CA)
-        self.serial_number = BambuMQTT.probe_serial_number(self.host, self.port)
+        self.is_connecting = False
+        self.is_disconnecting = False
+        self.loop = None
+        self.misc_task = None
+        self.pending_connect = None
+        self.conn_state = None
+        self.disconnected = None
+        self.pending_replies = dict()
+
+        # push_status frames are big and we only ever look at a few fields of them,
+        # when available let simdjson parse lazily instead of building a full dict.
+        self.json_parser = simdjson.Parser() if simdjson else None
+
+        # We grab the device_id from the cert once connected, should be fine (as we use the CA).
+        # A known serial number is only used as SNI (connect() probes it otherwise), the handshake always has the final say.
+        if not serial_number:
+            serial_number = BambuMQTT.get_cached_serial_number(self.host, self.port)
+
+        self.serial_number = serial_number
         self.mqttc = MQTTSClient(
             mqtt.CallbackAPIVersion.VERSION2, server_name=self.serial_number
         )
-        self.mqttc.tls_set(tls_version=ssl.PROTOCOL_TLS, cert_reqs=ssl.CERT_NONE)
+        self.mqttc.tls_set_context(_MQTT_SSL_CONTEXT)
         self.mqttc.user_data_set(self)
-        self.mqttc.reconnect_delay_set(min_delay=1, max_delay=1)
         self.mqttc.on_connect = self.__mqttc_on_connect
         self.mqttc.on_message = self.__mqttc_on_message
+
+        # We drive the client from the asyncio event loop instead of a paho worker thread.
+        self.mqttc.on_socket_open = self.__mqttc_on_socket_open
+        self.mqttc.on_socket_close = self.__mqttc_on_socket_close
+        self.mqttc.on_socket_register_write = self.__mqttc_on_socket_register_write
+        self.mqttc.on_socket_unregister_write = (
+            self.__mqttc_on_socket_unregister_write
+        )
         self.sequence_id = 0
         self.push_status_update_callback = None
         self.push_status_update_userdata = None
@@ -78,6 +205,8 @@ class BambuMQTT(object):
         callback: Optional[Callable[Dict[str, object], object]],
         userdata: Optional[object],
     ):
+        # NOTE: When simdjson is used, the payload given to the callback is a lazy view
+        # that is only valid for the duration of the call.
         self.push_status_update_callback = callback
         self.push_status_update_userdata = userdata
 
@@ -91,87 +220,292 @@ class BambuMQTT(object):
     def __mqttc_on_connect(
         client: mqtt.Client, userdata: "BambuMQTT", flags, reason_code, properties
     ):
-        if userdata.debug:
-            print(f"DEBUG: Connected with result code {reason_code}")
+        logger.debug("Connected with result code %s", reason_code)
+
+        # Don't wait for a push_status that will never come (wrong access code for example)
+        if reason_code.is_failure:
+            if userdata.is_connecting and not userdata.conn_state.done():
+                userdata.conn_state.set_exception(
+                    ConnectionRefusedError(f"MQTT connection refused: {reason_code}")
+                )
+                userdata.is_connecting = False
+
+            return
+
+        # The handshake already gave us the certificate, no need to probe it separately.
+        # Always read it as the printer behind this address might have changed since we cached it.
+        der_cert = client.socket().getpeercert(binary_form=True)
+        serial_number = get_certificate_common_name(der_cert) if der_cert else None
+
+        if not serial_number:
+            BambuMQTT.invalidate_serial_number(userdata.host, userdata.port)
+
+            # connect() tears the connection down itself when it fails
+            if userdata.is_connecting and not userdata.conn_state.done():
+                userdata.conn_state.set_exception(
+                    ConnectionError("MQTT server certificate has no common name")
+                )
+                userdata.is_connecting = False
+            else:
+                logger.warning("MQTT server certificate has no common name")
+                client.disconnect()
+
+            return
+
+        userdata.serial_number = serial_number
+        client._server_name = serial_number
+        BambuMQTT.cache_serial_number(userdata.host, userdata.port, serial_number)
+
         client.subscribe(f"device/{userdata.serial_number}/report")
 
     @staticmethod
-    def __mqttc_on_message(client: mqtt.Client, userdata: "BambuMQTT", msg):
+    def __materialize_payload(payload: object) -> object:
+        if simdjson and isinstance(payload, simdjson.Object):
+            return payload.as_dict()
 
-        payload = json.loads(msg.payload.decode("utf-8"))
+        return payload
 
-        if userdata.debug:
-            print(f"DEBUG: Received payload: {payload}")
+    @staticmethod
+    def __mqttc_on_message(client: mqtt.Client, userdata: "BambuMQTT", msg):
+        if userdata.json_parser:
+            payload = userdata.json_parser.parse(msg.payload)
+        else:
+            payload = json_loads(msg.payload)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Received payload: %s", BambuMQTT.__materialize_payload(payload)
+            )
 
         is_push_status = (
             payload.get("print") and payload["print"].get("command") == "push_status"
         )
 
         if is_push_status and userdata.is_connecting:
-            userdata.conn_state.put(True)
+            if not userdata.conn_state.done():
+                userdata.conn_state.set_result(True)
+
             userdata.is_connecting = False
 
         if not is_push_status:
-            userdata.internal_queue.put(payload)
+            # Hand the reply to whoever is waiting on this sequence id, if any.
+            sequence_id = payload.get("print") and payload["print"].get("sequence_id")
+            reply = userdata.pending_replies.pop(str(sequence_id), None)
+
+            if reply and not reply.done():
+                reply.set_result(BambuMQTT.__materialize_payload(payload))
         elif userdata.push_status_update_callback:
             userdata.push_status_update_callback(
                 payload, userdata.push_status_update_userdata
             )
 
-    def connect(self):
+    def __call_in_loop(self, callback: Callable, *args):
+        # paho (re)connects from an executor thread, forward its socket callbacks to the event loop.
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+
+        if in_loop:
+            callback(*args)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    @staticmethod
+    def __mqttc_on_socket_open(client: mqtt.Client, userdata: "BambuMQTT", sock):
+        def on_readable():
+            client.loop_read()
+
+            # Decrypted TLS records may already be buffered,
+            # in which case the socket won't be reported as readable again.
+            while (
+                isinstance(sock, ssl.SSLSocket)
+                and client.socket() is sock
+                and sock.pending()
+            ):
+                client.loop_read()
+
+        userdata.__call_in_loop(userdata.loop.add_reader, sock, on_readable)
+
+    @staticmethod
+    def __mqttc_on_socket_close(client: mqtt.Client, userdata: "BambuMQTT", sock):
+        def on_closed():
+            userdata.loop.remove_reader(sock)
+
+            if userdata.disconnected and not userdata.disconnected.done():
+                userdata.disconnected.set_result(True)
+
+        userdata.__call_in_loop(on_closed)
+
+    @staticmethod
+    def __mqttc_on_socket_register_write(
+        client: mqtt.Client, userdata: "BambuMQTT", sock
+    ):
+        userdata.__call_in_loop(userdata.loop.add_writer, sock, client.loop_write)
+
+    @staticmethod
+    def __mqttc_on_socket_unregister_write(
+        client: mqtt.Client, userdata: "BambuMQTT", sock
+    ):
+        userdata.__call_in_loop(userdata.loop.remove_writer, sock)
+
+    async def __run_connect(self, func: Callable, *args):
+        # TCP connect and TLS handshake are blocking, do them in an executor.
+        self.pending_connect = self.loop.run_in_executor(None, func, *args)
+
+        # If we get cancelled, the connection still goes on, disconnect() waits for it.
+        await asyncio.shield(self.pending_connect)
+
+    async def __misc_loop(self):
+        reconnect_delay = RECONNECT_MIN_DELAY
+
+        while not self.is_disconnecting:
+            if self.mqttc.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                # We lost the connection, try to reconnect like loop_start() would.
+                try:
+                    await self.__run_connect(self.mqttc.reconnect)
+                    reconnect_delay = RECONNECT_MIN_DELAY
+                except OSError:
+                    # Don't hammer a printer that is offline
+                    await asyncio.sleep(reconnect_delay)
+                    reconnect_delay = min(reconnect_delay * 2, RECONNECT_MAX_DELAY)
+
+            await asyncio.sleep(1)
+
+    async def connect(self, timeout: float = 30):
+        self.loop = asyncio.get_running_loop()
         self.is_connecting = True
+        self.is_disconnecting = False
+        self.conn_state = self.loop.create_future()
         self.mqttc.username_pw_set(self.user, password=self.pwd)
-        self.mqttc.connect(self.host, self.port, keepalive=60)
-        self.mqttc.loop_start()
-        self.conn_state.get()
 
-    def disconnect(self):
-        self.mqttc.disconnect()
-        self.mqttc.loop_stop()
+        try:
+            # The printer expects its serial number as SNI, the first time we get it from a one-shot handshake.
+            if not self.serial_number:
+                self.serial_number = await self.loop.run_in_executor(
+                    None, BambuMQTT.probe_serial_number, self.host, self.port, timeout
+                )
+                self.mqttc._server_name = self.serial_number
+
+            await self.__run_connect(self.mqttc.connect, self.host, self.port, 60)
+        except ssl.SSLError:
+            # The printer behind this address might have changed, pick up its CN on the next connection.
+            BambuMQTT.invalidate_serial_number(self.host, self.port)
+            self.serial_number = None
+            self.mqttc._server_name = None
+            raise
+
+        self.misc_task = self.loop.create_task(self.__misc_loop())
+
+        try:
+            await asyncio.wait_for(self.conn_state, timeout)
+        except BaseException:
+            await self.disconnect()
+            raise
+
+    async def disconnect(self):
+        self.is_disconnecting = True
+        self.is_connecting = False
+
+        if self.misc_task:
+            self.misc_task.cancel()
+            self.misc_task = None
+
+        # Let any in flight connection finish so we don't leak its socket.
+        if self.pending_connect:
+            await asyncio.wait([self.pending_connect])
+            self.pending_connect = None
 
-    def __enter__(self):
-        self.connect()
+        if self.mqttc.socket() is not None:
+            # The socket is closed once the DISCONNECT packet is written.
+            self.disconnected = self.loop.create_future()
+            self.mqttc.disconnect()
+            await asyncio.wait([self.disconnected], timeout=5)
+            self.disconnected = None
+
+    async def __aenter__(self):
+        await self.connect()
         return self
 
-    def __exit__(self, exception_type, exception_value, exception_traceback):
-        self.disconnect()
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        await self.disconnect()
 
     @staticmethod
-    def probe_serial_number(host: str, port: int) -> str:
+    def invalidate_serial_number(host: str, port: int):
+        with _SERIAL_NUMBER_CACHE_LOCK:
+            _SERIAL_NUMBER_CACHE.pop((host, port), None)
+
+    @staticmethod
+    def get_cached_serial_number(host: str, port: int) -> Optional[str]:
+        with _SERIAL_NUMBER_CACHE_LOCK:
+            entry = _SERIAL_NUMBER_CACHE.get((host, port))
+
+        if entry and time.monotonic() - entry[1] < SERIAL_NUMBER_CACHE_TTL:
+            return entry[0]
+
+        return None
+
+    @staticmethod
+    def cache_serial_number(host: str, port: int, serial_number: str):
+        # Only keep the CN around, that's all we need for the following connections.
+        with _SERIAL_NUMBER_CACHE_LOCK:
+            _SERIAL_NUMBER_CACHE[(host, port)] = (serial_number, time.monotonic())
+
+    @staticmethod
+    def probe_serial_number(
+        host: str, port: int, timeout: Optional[float] = None
+    ) -> Optional[str]:
+        serial_number = BambuMQTT.get_cached_serial_number(host, port)
+
+        if serial_number:
+            return serial_number
+
         # We need the serial number to do most operations, luckily for us the server cert contains it as CN.
-        raw_cert: str = ssl.get_server_certificate((host, port))
-        cert = x509.load_pem_x509_certificate(
-            raw_cert.encode("utf-8"), default_backend()
-        )
-        serial_number = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[
-            0
-        ].value
+        with socket.create_connection((host, port), timeout) as sock:
+            with _MQTT_SSL_CONTEXT.wrap_socket(sock) as ssock:
+                der_cert = ssock.getpeercert(binary_form=True)
+
+        serial_number = get_certificate_common_name(der_cert) if der_cert else None
+
+        if serial_number:
+            BambuMQTT.cache_serial_number(host, port, serial_number)
+
         return serial_number
 
-    def publish(self, message: object):
-        self.mqttc.publish(f"device/{self.serial_number}/request", json.dumps(message))
+    def publish(self, message: Union[object, bytes]):
+        # Already serialized messages are sent as is
+        if not isinstance(message, bytes):
+            message = json_dumps(message)
 
-    def publish_with_reply(self, message: object) -> object:
-        self.publish(message)
+        self.mqttc.publish(f"device/{self.serial_number}/request", message)
 
-        res = self.internal_queue.get()
-        self.internal_queue.task_done()
+    async def publish_with_reply(
+        self,
+        message: Union[object, bytes],
+        sequence_id: Optional[int] = None,
+        timeout: float = 30,
+    ) -> object:
+        if sequence_id is None:
+            sequence_id = message["print"]["sequence_id"]
 
-        return res
+        key = str(sequence_id)
+        reply = asyncio.get_running_loop().create_future()
+        self.pending_replies[key] = reply
 
-    def run_raw_gcode(self, gcode: str) -> object:
-        msg = {
-            "print": {
-                "sequence_id": str(self.__get_next_sequence_id()),
-                "command": "gcode_line",
-                "param": gcode,
-                "user_id": "0",
-            },
-        }
+        try:
+            self.publish(message)
+
+            return await asyncio.wait_for(reply, timeout)
+        finally:
+            self.pending_replies.pop(key, None)
+
+    async def run_raw_gcode(self, gcode: str) -> object:
+        sequence_id = self.__get_next_sequence_id()
+        msg = _GCODE_LINE_REQUEST % (sequence_id, json_dumps(gcode))
 
-        return self.publish_with_reply(msg)
+        return await self.publish_with_reply(msg, sequence_id)
 
-    def print_gcode(self, url: str) -> object:
+    async def print_gcode(self, url: str) -> object:
         msg = {
             "print": {
                 "sequence_id": str(self.__get_next_sequence_id()),
@@ -180,9 +514,9 @@ class BambuMQTT(object):
             },
         }
 
-        return self.publish_with_reply(msg)
+        return await self.publish_with_reply(msg)
 
-    def print_project(
+    async def print_project(
         self,
         url: str,
         ams_mapping: List[int],
@@ -222,48 +556,27 @@ class BambuMQTT(object):
             },
         }
 
-        return self.publish_with_reply(msg)
+        return await self.publish_with_reply(msg)
 
     def stop_print_no_reply(self, with_reply: bool = True) -> object:
-        msg = {
-            "print": {
-                "sequence_id": str(self.__get_next_sequence_id()),
-                "command": "stop",
-                "param": "",
-            },
-        }
+        msg = _STOP_REQUEST % self.__get_next_sequence_id()
 
         self.publish(msg)
 
-    def stop_print(self) -> object:
-        msg = {
-            "print": {
-                "sequence_id": str(self.__get_next_sequence_id()),
-                "command": "stop",
-                "param": "",
-            },
-        }
+    async def stop_print(self) -> object:
+        sequence_id = self.__get_next_sequence_id()
+        msg = _STOP_REQUEST % sequence_id
 
-        return self.publish_with_reply(msg)
+        return await self.publish_with_reply(msg, sequence_id)
 
-    def pause_print(self) -> object:
-        msg = {
-            "print": {
-                "sequence_id": str(self.__get_next_sequence_id()),
-                "command": "pause",
-                "param": "",
-            },
-        }
+    async def pause_print(self) -> object:
+        sequence_id = self.__get_next_sequence_id()
+        msg = _PAUSE_REQUEST % sequence_id
 
-        return self.publish_with_reply(msg)
+        return await self.publish_with_reply(msg, sequence_id)
 
-    def resume_print(self) -> object:
-        msg = {
-            "print": {
-                "sequence_id": str(self.__get_next_sequence_id()),
-                "command": "resume",
-                "param": "",
-            },
-        }
+    async def resume_print(self) -> object:
+        sequence_id = self.__get_next_sequence_id()
+        msg = _RESUME_REQUEST % sequence_id
 
-        return self.publish_with_reply(msg)
+        return await self.publish_with_reply(msg, sequence_id)
@@ -5,11 +5,18 @@ from typing import Union, IO, Any
 from pathlib import Path
 
 
+# Shared by all connections, the printer certificate isn't verified (like ftplib's default context).
+_FTP_SSL_CONTEXT = ssl.create_default_context()
+_FTP_SSL_CONTEXT.check_hostname = False
+_FTP_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+
 # From https://stackoverflow.com/a/36049814
 class ImplicitFTP_TLS(ftplib.FTP_TLS):
     """FTP_TLS subclass that automatically wraps sockets in SSL to support implicit FTPS."""
 
     def __init__(self, *args, **kwargs):
+        kwargs.setdefault("context", _FTP_SSL_CONTEXT)
         super().__init__(*args, **kwargs)
         self._sock = None
 
@@ -25,6 +32,17 @@ class ImplicitFTP_TLS(ftplib.FTP_TLS):
             value = self.context.wrap_socket(value)
         self._sock = value
 
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+
+        if self._prot_p:
+            # Resume the TLS session of the control connection, this avoids a full handshake per transfer.
+            conn = self.context.wrap_socket(
+                conn, server_hostname=self.host, session=self.sock.session
+            )
+
+        return conn, size
+
 
 class BambuSFTP(object):
     sftp: ImplicitFTP_TLS
@@ -32,14 +50,17 @@ class BambuSFTP(object):
     port: int
     user: str
     pwd: str
+    timeout: float
 
-    def __init__(self, host: str, port: int, user: str, pwd: str):
+    def __init__(self, host: str, port: int, user: str, pwd: str, timeout: float = 30):
         self.host = host
         self.port = port
         self.user = user
         self.pwd = pwd
+        self.timeout = timeout
 
-        self.sftp = ImplicitFTP_TLS()
+        # Don't wait forever on a printer that went away, this also applies to the data connections.
+        self.sftp = ImplicitFTP_TLS(timeout=timeout)
 
     def connect(self):
         self.sftp.connect(self.host, self.port)
@@ -68,8 +89,15 @@ class BambuSFTP(object):
         self.sftp.voidcmd("TYPE I")
 
         with self.sftp.transfercmd(f"STOR {file_name}", None) as conn:
-            while buf := fp.read(0x10000):
-                conn.sendall(buf)
+            if isinstance(conn, ssl.SSLSocket):
+                # sendfile() can't be used with TLS, use bigger chunks to reduce the amount of calls instead.
+                while buf := fp.read(0x100000):
+                    conn.sendall(buf)
+
+                # Like ftplib, properly shutdown TLS to not lose data on the server side.
+                conn.unwrap()
+            else:
+                conn.sendfile(fp)
 
         self.sftp.voidresp()
 
@@ -88,4 +116,7 @@ class BambuSFTP(object):
         with self.sftp.transfercmd(f"STOR {file_name}", None) as conn:
             conn.sendall(raw_data)
 
+            if isinstance(conn, ssl.SSLSocket):
+                conn.unwrap()
+
         self.sftp.voidresp()
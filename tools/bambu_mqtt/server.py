@@ -1,24 +1,30 @@
-from bambu_mqtt import BambuMQTT
+from bambu_mqtt import BambuMQTT, json_dumps
 from bambu_sftp import BambuSFTP
 
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 
-import json
-import tornado.httpserver, tornado.web
+import asyncio
+import email.message
+import ftplib
+import functools
+import tornado.httpserver, tornado.ioloop, tornado.web
 import os
+import re
 import time
 
 
-def parse_x_api_key(raw: str) -> Optional[Dict[str, str]]:
-    res = dict()
+# "key=value" entries separated by ";"
+_X_API_KEY_RE = re.compile(r"[^=;]*=[^=;]*(?:;[^=;]*=[^=;]*)*")
+_X_API_KEY_ENTRY_RE = re.compile(r"([^=;]*)=([^=;]*)")
 
-    for raw_entry in raw.split(";"):
-        parts = raw_entry.split("=")
 
-        if len(parts) != 2:
-            return None
+# NOTE: The same key is sent with every request, the result is cached and must not be modified.
+@functools.lru_cache(maxsize=64)
+def parse_x_api_key(raw: str) -> Optional[Dict[str, str]]:
+    if not _X_API_KEY_RE.fullmatch(raw):
+        return None
 
-        res[parts[0]] = parts[1]
+    res = dict(_X_API_KEY_ENTRY_RE.findall(raw))
 
     if not res.get("host") or not res.get("pass"):
         return None
@@ -30,15 +36,149 @@ def parse_x_api_key(raw: str) -> Optional[Dict[str, str]]:
     res["flow_calibration"] = res.get("flow_calibration", "true") == "true"
     res["vibration_calibration"] = res.get("vibration_calibration", "true") == "true"
     res["layer_inspect"] = res.get("layer_inspect", "true") == "true"
-    tmp_ams_mapping = res.get("ams_mapping", "").split(",")
 
-    res["ams_mapping"] = list()
-    for entry in tmp_ams_mapping:
-        res["ams_mapping"].append(int(entry))
+    # Skip empty entries (trailing commas) and reject the key on invalid ones
+    try:
+        res["ams_mapping"] = [
+            int(entry) for entry in res.get("ams_mapping", "").split(",") if entry
+        ]
+    except ValueError:
+        return None
 
     return res
 
 
+class PrinterConnection(object):
+    host: str
+    user: str
+    pwd: str
+    lock: asyncio.Lock
+    last_used: float
+    mqtt: Optional[BambuMQTT]
+    sftp: Optional[BambuSFTP]
+
+    def __init__(self, host: str, user: str, pwd: str):
+        self.host = host
+        self.user = user
+        self.pwd = pwd
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self.mqtt = None
+        self.sftp = None
+
+    def get_sftp(self) -> BambuSFTP:
+        if self.sftp:
+            try:
+                # Previous uploads might have left us in another directory,
+                # this also makes sure the connection is still alive.
+                self.sftp.sftp.cwd("/")
+            except (OSError, EOFError, ftplib.Error):
+                self.close_sftp()
+
+        if not self.sftp:
+            self.sftp = BambuSFTP(self.host, 990, self.user, self.pwd)
+            self.sftp.connect()
+
+        return self.sftp
+
+    def close_sftp(self):
+        if self.sftp:
+            try:
+                self.sftp.disconnect()
+            except Exception:
+                self.sftp.sftp.close()
+
+            self.sftp = None
+
+    def keepalive_sftp(self):
+        if self.sftp:
+            try:
+                self.sftp.sftp.voidcmd("NOOP")
+            except (OSError, EOFError, ftplib.Error):
+                self.close_sftp()
+
+    async def get_mqtt(self) -> BambuMQTT:
+        if self.mqtt and not self.mqtt.mqttc.is_connected():
+            await self.close_mqtt()
+
+        if not self.mqtt:
+            mqtt = BambuMQTT(self.host, 8883, self.user, self.pwd, debug=False)
+
+            try:
+                await mqtt.connect()
+            except BaseException:
+                await mqtt.disconnect()
+                raise
+
+            self.mqtt = mqtt
+
+        return self.mqtt
+
+    async def close_mqtt(self):
+        if self.mqtt:
+            mqtt = self.mqtt
+            self.mqtt = None
+            await mqtt.disconnect()
+
+    async def close(self):
+        # QUIT waits on the printer, don't stall the event loop for it
+        await tornado.ioloop.IOLoop.current().run_in_executor(None, self.close_sftp)
+        await self.close_mqtt()
+
+
+class PrinterConnPool(object):
+    """
+    Keep the connections to the printers alive between requests to avoid redoing TLS handshakes and logins.
+    Uploads to the same printer are serialized, while different printers can be used concurrently.
+    Connections that haven't been used for IDLE_TIMEOUT seconds are closed.
+    """
+
+    IDLE_TIMEOUT = 10 * 60
+
+    connections: Dict[Tuple[str, str, str], PrinterConnection]
+
+    def __init__(self):
+        self.connections = dict()
+
+    async def acquire(self, host: str, user: str, pwd: str) -> PrinterConnection:
+        key = (host, user, pwd)
+        conn = self.connections.get(key)
+
+        if not conn:
+            conn = PrinterConnection(host, user, pwd)
+            self.connections[key] = conn
+
+        await conn.lock.acquire()
+        conn.last_used = time.monotonic()
+
+        return conn
+
+    def release(self, conn: PrinterConnection):
+        conn.last_used = time.monotonic()
+        conn.lock.release()
+
+    async def keepalive(self):
+        now = time.monotonic()
+
+        for key, conn in list(self.connections.items()):
+            # Connections currently in use don't need it
+            if conn.lock.locked():
+                continue
+
+            if now - conn.last_used > self.IDLE_TIMEOUT:
+                # Nobody is waiting on an unlocked connection, the next acquire will create a new one
+                del self.connections[key]
+
+                async with conn.lock:
+                    await conn.close()
+            else:
+                # Hold the lock so that requests don't use the connection while the NOOP is in flight
+                async with conn.lock:
+                    await tornado.ioloop.IOLoop.current().run_in_executor(
+                        None, conn.keepalive_sftp
+                    )
+
+
 class BaseRequestHandler(tornado.web.RequestHandler):
     def prepare(self):
         if "X-Api-Key" not in self.request.headers:
@@ -52,46 +192,382 @@ class BaseRequestHandler(tornado.web.RequestHandler):
 
 class IndexHandler(BaseRequestHandler):
     def get(self):
+        self.set_header("Content-Type", "application/json")
         self.write(
-            {
-                "api": "0.1",
-                "server": "1.3.10",
-                # Need to start with "OctoPrint" for OrcaSlicer to understand us...
-                "text": "OctoPrint Compatible Turion Link 0.0.1",
-            }
+            json_dumps(
+                {
+                    "api": "0.1",
+                    "server": "1.3.10",
+                    # Need to start with "OctoPrint" for OrcaSlicer to understand us...
+                    "text": "OctoPrint Compatible Turion Link 0.0.1",
+                }
+            )
         )
 
 
+class MultipartStreamParser(object):
+    """
+    Incremental multipart/form-data parser, used to stream uploaded files without buffering them.
+    feed() returns a list of events: ("field", name, value), ("file_start", name, filename), ("file_data", data) and ("file_end",).
+    """
+
+    STATE_PREAMBLE = 0
+    STATE_DELIMITER = 1
+    STATE_HEADERS = 2
+    STATE_BODY = 3
+    STATE_END = 4
+
+    delimiter: bytes
+    buffer: bytearray
+    state: int
+    part_name: Optional[str]
+    part_filename: Optional[str]
+    part_value: bytearray
+
+    def __init__(self, boundary: bytes):
+        self.delimiter = b"\r\n--" + boundary
+        # The first boundary isn't preceded by a CRLF, pretend it is.
+        self.buffer = bytearray(b"\r\n")
+        self.state = MultipartStreamParser.STATE_PREAMBLE
+        self.part_name = None
+        self.part_filename = None
+        self.part_value = bytearray()
+
+    def __end_part(self, events: List[Tuple]):
+        if self.part_filename is not None:
+            events.append(("file_end",))
+        elif self.part_name is not None:
+            events.append(("field", self.part_name, self.part_value.decode("utf-8")))
+
+        self.part_value = bytearray()
+
+    def __part_data(self, events: List[Tuple], data: bytes):
+        if self.part_filename is not None:
+            if data:
+                events.append(("file_data", data))
+        else:
+            self.part_value += data
+
+    def feed(self, data: bytes) -> List[Tuple]:
+        events = []
+        self.buffer += data
+
+        while True:
+            if self.state == MultipartStreamParser.STATE_PREAMBLE:
+                idx = self.buffer.find(self.delimiter)
+
+                if idx < 0:
+                    del self.buffer[: max(0, len(self.buffer) - len(self.delimiter))]
+                    break
+
+                del self.buffer[: idx + len(self.delimiter)]
+                self.state = MultipartStreamParser.STATE_DELIMITER
+            elif self.state == MultipartStreamParser.STATE_DELIMITER:
+                if len(self.buffer) < 2:
+                    break
+
+                if self.buffer[:2] == b"--":
+                    self.buffer.clear()
+                    self.state = MultipartStreamParser.STATE_END
+                    break
+
+                del self.buffer[:2]
+                self.state = MultipartStreamParser.STATE_HEADERS
+            elif self.state == MultipartStreamParser.STATE_HEADERS:
+                idx = self.buffer.find(b"\r\n\r\n")
+
+                if idx < 0:
+                    break
+
+                headers = email.message.Message()
+                for raw_header in self.buffer[:idx].decode("utf-8").split("\r\n"):
+                    key, _, value = raw_header.partition(":")
+                    headers[key.strip()] = value.strip()
+
+                del self.buffer[: idx + 4]
+
+                self.part_name = headers.get_param(
+                    "name", header="content-disposition"
+                )
+                self.part_filename = headers.get_filename()
+
+                if self.part_filename is not None:
+                    events.append(("file_start", self.part_name, self.part_filename))
+
+                self.state = MultipartStreamParser.STATE_BODY
+            elif self.state == MultipartStreamParser.STATE_BODY:
+                idx = self.buffer.find(self.delimiter)
+
+                if idx < 0:
+                    # Keep enough around to match a delimiter split across chunks.
+                    size = len(self.buffer) - len(self.delimiter)
+
+                    if size > 0:
+                        self.__part_data(events, bytes(self.buffer[:size]))
+                        del self.buffer[:size]
+
+                    break
+
+                self.__part_data(events, bytes(self.buffer[:idx]))
+                self.__end_part(events)
+                del self.buffer[: idx + len(self.delimiter)]
+                self.state = MultipartStreamParser.STATE_DELIMITER
+            else:
+                self.buffer.clear()
+                break
+
+        return events
+
+
+class AsyncQueueReader(object):
+    """
+    File-like object that allows blocking code running in another thread to read chunks pushed to an asyncio.Queue.
+    None marks the end of the stream, ABORT makes the reader raise.
+    """
+
+    ABORT = object()
+
+    queue: asyncio.Queue
+    loop: asyncio.AbstractEventLoop
+    eof: bool
+
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        self.queue = queue
+        self.loop = loop
+        self.eof = False
+
+    def read(self, size: int = -1) -> bytes:
+        # NOTE: We return whatever chunk we got, this might be more than size.
+        if self.eof:
+            return b""
+
+        chunk = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+
+        if chunk is AsyncQueueReader.ABORT:
+            raise ConnectionAbortedError("Upload aborted")
+
+        if chunk is None:
+            self.eof = True
+            return b""
+
+        return chunk
+
+
+def upload_project(
+    printer_conn: PrinterConnection,
+    upload_path: str,
+    project_printer_path: str,
+    reader: AsyncQueueReader,
+):
+    printer_sftp = printer_conn.get_sftp()
+    printer_sftp.enter_create_directories(upload_path)
+    # First we upload the project file
+    printer_sftp.delete(project_printer_path)
+    printer_sftp.store_file(project_printer_path, reader)
+
+
+def delete_project(
+    printer_conn: PrinterConnection, upload_path: str, project_printer_path: str
+):
+    printer_sftp = printer_conn.get_sftp()
+    printer_sftp.enter_create_directories(upload_path)
+    printer_sftp.delete(project_printer_path)
+
+
+@tornado.web.stream_request_body
 class PrintHandler(BaseRequestHandler):
-    def post(self):
-        command = self.get_body_argument("command", "select")
+    def initialize(self, pool: PrinterConnPool):
+        self.pool = pool
+        self.printer_conn = None
+        self.multipart = None
+        self.fields = dict()
+        self.file_name = None
+        self.file_error = None
+        self.upload_path = None
+        self.upload_queue = None
+        self.upload_task = None
+        self.mqtt_task = None
+        self.is_receiving_file = False
+        self.is_body_received = False
+
+    async def prepare(self):
+        super().prepare()
+
+        boundary = None
+        content_type = self.request.headers.get("Content-Type", "")
+
+        if content_type.startswith("multipart/form-data"):
+            for field in content_type.split(";"):
+                key, _, value = field.strip().partition("=")
+
+                if key == "boundary" and value:
+                    boundary = value.strip('"').encode("utf-8")
+
+        if not boundary:
+            raise tornado.web.HTTPError(400)
+
+        self.multipart = MultipartStreamParser(boundary)
+
+        # We upload while receiving the body, so we need the printer right away.
+        self.printer_conn = await self.pool.acquire(
+            self.serv_config["host"], self.serv_config["user"], self.serv_config["pass"]
+        )
 
-        # We implement the minimal subset needed by OrcaSlicer
-        if command != "select":
-            self.write_error(503)
-            return
+    def get_field(self, name: str, default: str) -> str:
+        value = self.fields.get(name)
 
-        print_file = self.request.arguments.get("print", [b"false"])[-1] == b"true"
-        upload_path = self.request.arguments.get("path", [b""])[-1].decode("utf-8")
+        if value is None:
+            value = self.get_query_argument(name, default)
 
-        if len(self.request.files) == 0:
-            self.write_error(400)
-            return
+        return value
 
-        first_entry_key = next(iter(self.request.files))
-        file_info = self.request.files[first_entry_key][0]
-        file_name: str = file_info["filename"]
-        file_data = file_info["body"]
+    def __start_upload(self, file_name: str):
+        self.file_name = file_name
 
-        with open(file_name, "wb") as f:
-            f.write(file_data)
+        # We implement the minimal subset needed by OrcaSlicer
+        if self.get_field("command", "select") != "select":
+            self.file_error = 503
+            return
 
         # We only support 3MF with embedded GCODE
         if not file_name.endswith(".3mf"):
-            self.write_error(503)
+            self.file_error = 503
             return
 
-        project_printer_path = os.path.basename(file_name)
+        self.upload_path = self.get_field("path", "")
+        self.upload_queue = asyncio.Queue(maxsize=16)
+        self.is_receiving_file = True
+
+        loop = asyncio.get_running_loop()
+        self.upload_task = loop.run_in_executor(
+            None,
+            upload_project,
+            self.printer_conn,
+            self.upload_path,
+            os.path.basename(file_name),
+            AsyncQueueReader(self.upload_queue, loop),
+        )
+
+        # Connect to MQTT while the upload is going on if we know we will need it.
+        if self.get_field("print", "false") == "true":
+            self.mqtt_task = asyncio.ensure_future(self.printer_conn.get_mqtt())
+
+    async def __push_upload_data(self, data: Optional[bytes]):
+        put_task = asyncio.ensure_future(self.upload_queue.put(data))
+
+        # Don't wait forever if the upload died on us.
+        await asyncio.wait(
+            [put_task, self.upload_task], return_when=asyncio.FIRST_COMPLETED
+        )
+
+        if not put_task.done():
+            put_task.cancel()
+
+    async def data_received(self, chunk: bytes):
+        for event in self.multipart.feed(chunk):
+            if event[0] == "field":
+                self.fields[event[1]] = event[2]
+
+                # The upload started as soon as the file showed up, we can't honor a path or command sent after it.
+                if self.upload_task and self.file_error is None:
+                    if (
+                        self.get_field("path", "") != self.upload_path
+                        or self.get_field("command", "select") != "select"
+                    ):
+                        self.file_error = 400
+                        self.__stop_upload()
+            elif event[0] == "file_start" and self.file_name is None:
+                self.__start_upload(event[2])
+            elif event[0] == "file_data" and self.is_receiving_file:
+                await self.__push_upload_data(event[1])
+            elif event[0] == "file_end" and self.is_receiving_file:
+                self.is_receiving_file = False
+                await self.__push_upload_data(None)
+
+    def release_printer_conn(self):
+        if self.printer_conn:
+            self.pool.release(self.printer_conn)
+            self.printer_conn = None
+
+    async def __close_printer_conn(self):
+        if self.mqtt_task:
+            if not self.mqtt_task.done():
+                self.mqtt_task.cancel()
+            elif not self.mqtt_task.cancelled():
+                # Consume the connection failure so asyncio doesn't report it as never retrieved
+                self.mqtt_task.exception()
+
+        # Don't keep connections around in an unknown state
+        await self.printer_conn.close()
+
+    def __stop_upload(self):
+        # Makes the reader raise, unless the whole file was already read.
+        self.is_receiving_file = False
+
+        while not self.upload_queue.empty():
+            self.upload_queue.get_nowait()
+
+        self.upload_queue.put_nowait(AsyncQueueReader.ABORT)
+
+    async def __abort_upload(self):
+        if self.upload_task:
+            self.__stop_upload()
+
+            loop = asyncio.get_running_loop()
+
+            try:
+                await self.upload_task
+            except Exception:
+                # The transfer was cut short, the control connection can't be trusted anymore.
+                await loop.run_in_executor(None, self.printer_conn.close_sftp)
+
+            # Don't leave a partial or misplaced project on the printer
+            try:
+                await loop.run_in_executor(
+                    None,
+                    delete_project,
+                    self.printer_conn,
+                    self.upload_path,
+                    os.path.basename(self.file_name),
+                )
+            except Exception:
+                pass
+
+            await self.__close_printer_conn()
+
+        self.release_printer_conn()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+
+        # The client went away before sending the whole body, post() won't be called.
+        if not self.is_body_received and self.printer_conn:
+            asyncio.ensure_future(self.__abort_upload())
+
+    def on_finish(self):
+        if not self.is_body_received:
+            self.release_printer_conn()
+
+    async def post(self):
+        self.is_body_received = True
+
+        try:
+            await self.__post()
+        finally:
+            self.release_printer_conn()
+
+    async def __post(self):
+        if self.file_name is None:
+            raise tornado.web.HTTPError(400)
+
+        # Set when the file part was rejected or a field came too late, the body ending early is also an error.
+        if self.file_error is not None or self.is_receiving_file:
+            await self.__abort_upload()
+            raise tornado.web.HTTPError(self.file_error or 400)
+
+        file_name: str = self.file_name
+        print_file = self.get_field("print", "false") == "true"
+        upload_path = self.upload_path
 
         host = self.serv_config["host"]
         username = self.serv_config["user"]
@@ -109,17 +585,19 @@ class PrintHandler(BaseRequestHandler):
         else:
             project_printer_uri = f"file:///sdcard/{upload_path}/{file_name}"
 
-        print(f"Uploading {project_printer_uri}")
-        with BambuSFTP(host, 990, username, password) as printer_sftp:
-            printer_sftp.enter_create_directories(upload_path)
-            # First we upload the project file
-            printer_sftp.delete(project_printer_path)
-            printer_sftp.store_data(project_printer_path, file_data)
-        print(f"Uploaded {project_printer_uri}")
-
-        if print_file:
-            with BambuMQTT(host, 8883, username, password, debug=False) as mqtt:
-                res = mqtt.print_project(
+        printer_conn = self.printer_conn
+
+        try:
+            print(f"Uploading {project_printer_uri}")
+            await self.upload_task
+            print(f"Uploaded {project_printer_uri}")
+
+            if print_file:
+                if self.mqtt_task:
+                    mqtt = await self.mqtt_task
+                else:
+                    mqtt = await printer_conn.get_mqtt()
+                res = await mqtt.print_project(
                     project_printer_uri,
                     ams_mapping,
                     1,
@@ -133,17 +611,25 @@ class PrintHandler(BaseRequestHandler):
                 )
 
                 if res["print"]["result"] != "success":
-                    self.write_error(419)
+                    self.send_error(419)
                     return
+        except Exception:
+            await self.__close_printer_conn()
+            raise
 
         self.set_status(204)
 
 
 if __name__ == "__main__":
+    pool = PrinterConnPool()
     application = tornado.web.Application(
-        [(r"/api/version", IndexHandler), (r"/api/files/local", PrintHandler)],
+        [
+            (r"/api/version", IndexHandler),
+            (r"/api/files/local", PrintHandler, dict(pool=pool)),
+        ],
         debug=False,
     )
 
     application.listen(9931)
+    tornado.ioloop.PeriodicCallback(pool.keepalive, 30 * 1000).start()
     tornado.ioloop.IOLoop.instance().start()
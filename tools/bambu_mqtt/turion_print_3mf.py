@@ -1,10 +1,11 @@
 from bambu_mqtt import BambuMQTT
 from bambu_sftp import BambuSFTP
 from pathlib import Path
-from typing import Dict
+from typing import Mapping
 import argparse
+import asyncio
+import logging
 import sys
-import time
 import os
 
 parser = argparse.ArgumentParser(
@@ -21,6 +22,8 @@ parser.add_argument("--debug", action="store_true")
 
 args = parser.parse_args()
 
+logging.basicConfig(format="%(levelname)s: %(message)s")
+
 project_file_path = args.project_file_path
 project_printer_path = os.path.basename(project_file_path)
 project_printer_url = f"file:///sdcard/{project_printer_path}"
@@ -33,24 +36,26 @@ elif not ams_mapping:
     ams_mapping = list()
 
 
-print(f"Uploading {project_file_path}")
-with BambuSFTP(args.host, 990, args.username, args.password) as printer_sftp:
-    # First we upload the project file
-    printer_sftp.delete(project_printer_path)
+should_track_state = True
+exit_code = 0
 
-    with open(project_file_path, "rb") as f:
-        printer_sftp.store_file(project_printer_path, f)
 
-printer_mqtt = BambuMQTT(
-    args.host, 8883, args.username, args.password, debug=args.debug
-)
-printer_mqtt.connect()
+def on_print_finished(mqtt: BambuMQTT):
+    global should_track_state
+    global exit_code
+
+    print("Print completed")
+    should_track_state = False
+    exit_code = 0
 
-should_track_state = True
-exit_code = 0
 
+# Actions to take when the printer reports a given gcode_state
+GCODE_STATE_HANDLERS = {
+    "FINISH": on_print_finished,
+}
 
-def printer_state_tracker(res: Dict[str, object], mqtt: BambuMQTT):
+
+def printer_state_tracker(res: Mapping[str, object], mqtt: BambuMQTT):
     global should_track_state
     global exit_code
 
@@ -77,33 +82,66 @@ def printer_state_tracker(res: Dict[str, object], mqtt: BambuMQTT):
         should_track_state = False
         exit_code = 1
 
-    if gcode_state == "FINISH":
-        print("Print completed")
-        should_track_state = False
-        exit_code = 0
+    state_handler = GCODE_STATE_HANDLERS.get(gcode_state)
+
+    if state_handler:
+        state_handler(mqtt)
 
     if not should_track_state:
-        printer_mqtt.set_push_status_update_callback(None, None)
+        mqtt.set_push_status_update_callback(None, None)
 
 
-printer_mqtt.set_push_status_update_callback(printer_state_tracker, printer_mqtt)
+def upload_project():
+    print(f"Uploading {project_file_path}")
+    with BambuSFTP(args.host, 990, args.username, args.password) as printer_sftp:
+        # First we upload the project file
+        printer_sftp.delete(project_printer_path)
 
-print(f"Starting print of {project_printer_url}")
-res = printer_mqtt.print_project(project_printer_url, ams_mapping)
+        with open(project_file_path, "rb") as f:
+            printer_sftp.store_file(project_printer_path, f)
 
-if res["print"]["result"] == "success":
-    print("Print successfully started")
-else:
-    # Force stop the print
-    printer_mqtt.stop_print()
-    reason = res["print"]["reason"]
-    print(f"Print error: {reason}")
-    should_track_state = False
-    printer_mqtt.disconnect()
-    sys.exit(1)
 
-while should_track_state:
-    time.sleep(1)
+async def main() -> int:
+    global should_track_state
+
+    printer_mqtt = BambuMQTT(
+        args.host, 8883, args.username, args.password, debug=args.debug
+    )
+
+    # Both are independent, connect to MQTT while the upload is going on.
+    # The MQTT connection is established from an executor too, so neither side waits on the other.
+    results = await asyncio.gather(
+        asyncio.get_running_loop().run_in_executor(None, upload_project),
+        printer_mqtt.connect(),
+        return_exceptions=True,
+    )
+
+    for result in results:
+        if isinstance(result, BaseException):
+            await printer_mqtt.disconnect()
+            raise result
+
+    printer_mqtt.set_push_status_update_callback(printer_state_tracker, printer_mqtt)
+
+    print(f"Starting print of {project_printer_url}")
+    res = await printer_mqtt.print_project(project_printer_url, ams_mapping)
+
+    if res["print"]["result"] == "success":
+        print("Print successfully started")
+    else:
+        # Force stop the print
+        await printer_mqtt.stop_print()
+        reason = res["print"]["reason"]
+        print(f"Print error: {reason}")
+        should_track_state = False
+        await printer_mqtt.disconnect()
+        return 1
+
+    while should_track_state:
+        await asyncio.sleep(1)
+
+    await printer_mqtt.disconnect()
+    return exit_code
+
 
-printer_mqtt.disconnect()
-sys.exit(exit_code)
+sys.exit(asyncio.run(main()))
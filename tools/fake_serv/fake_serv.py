@@ -1,4 +1,4 @@
-import argparse, socket, ssl, os
+import argparse, selectors, socket, ssl, os
 
 parser = argparse.ArgumentParser(
     prog="fake_serv",
@@ -25,7 +25,7 @@ os.makedirs("packets", exist_ok=True)
 
 bindsocket = socket.socket()
 bindsocket.bind(("", args.port))
-bindsocket.listen(5)
+bindsocket.listen(128)
 
 
 def dump_data(direction: str, data: bytes, idx: int):
@@ -33,6 +33,22 @@ def dump_data(direction: str, data: bytes, idx: int):
         f.write(data)
 
 
+def flush_backlog(sel: selectors.BaseSelector, sock: ssl.SSLSocket, backlog: bytearray):
+    try:
+        while backlog:
+            sent = sock.send(backlog)
+            del backlog[:sent]
+    except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+        pass
+
+    # Only wait for the socket to be writable if we still have something to send
+    events = selectors.EVENT_READ
+    if backlog:
+        events |= selectors.EVENT_WRITE
+
+    sel.modify(sock, events)
+
+
 while True:
     newsocket, fromaddr = bindsocket.accept()
     connstream = server_ctx.wrap_socket(newsocket, server_side=True)
@@ -40,25 +56,42 @@ while True:
 
     idx = 0
 
-    with socket.create_connection((args.host, args.port)) as sock:
+    with connstream, socket.create_connection((args.host, args.port)) as sock:
         with client_ctx.wrap_socket(sock) as ssock:
             ssock.setblocking(False)
-            while True:
-                # read client data
-                try:
-                    client_data = connstream.recv()
-                    if len(client_data) != 0:
-                        dump_data("client", client_data, idx)
-                        idx += 1
-                    ssock.send(client_data)
-                except ssl.SSLWantReadError:
-                    pass
-
-                try:
-                    server_data = ssock.recv()
-                    if len(server_data) != 0:
-                        dump_data("server", server_data, idx)
-                        idx += 1
-                    connstream.send(server_data)
-                except ssl.SSLWantReadError:
-                    pass
+
+            peers = {connstream: ssock, ssock: connstream}
+            directions = {connstream: "client", ssock: "server"}
+            # Data waiting to be sent to a given socket
+            backlogs = {connstream: bytearray(), ssock: bytearray()}
+
+            with selectors.DefaultSelector() as sel:
+                sel.register(connstream, selectors.EVENT_READ)
+                sel.register(ssock, selectors.EVENT_READ)
+
+                is_open = True
+                while is_open:
+                    for key, events in sel.select():
+                        ready_sock = key.fileobj
+                        peer_sock = peers[ready_sock]
+
+                        if events & selectors.EVENT_READ:
+                            # Read until empty as TLS might have more data buffered
+                            while True:
+                                try:
+                                    data = ready_sock.recv(0x10000)
+                                except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                                    break
+
+                                if len(data) == 0:
+                                    is_open = False
+                                    break
+
+                                dump_data(directions[ready_sock], data, idx)
+                                idx += 1
+                                backlogs[peer_sock] += data
+
+                            flush_backlog(sel, peer_sock, backlogs[peer_sock])
+
+                        if events & selectors.EVENT_WRITE:
+                            flush_backlog(sel, ready_sock, backlogs[ready_sock])
@@ -5,6 +5,8 @@
 import socket
 import ssl
 import argparse
+import os
+import signal
 import struct
 import sys
 
@@ -14,12 +16,14 @@ context.verify_mode = ssl.CERT_NONE
 
 BAMBU_CAMERA_STREAM = 0x3000
 
+PACKET_HEADER = struct.Struct("IIII")
+LOGIN_CREDENTIALS = struct.Struct("32s32s")
+
 
 def generate_header_packet(
     size: int, packet_type: int, flags: int, word3: int
 ) -> bytes:
-    res = struct.pack(
-        "IIII",
+    res = PACKET_HEADER.pack(
         size,
         packet_type,
         flags,
@@ -33,32 +37,44 @@ def generate_login_packet(
     password: str,
 ) -> bytes:
     res = generate_header_packet(0x40, BAMBU_CAMERA_STREAM, 0, 0)
-    res += struct.pack(
-        "32s32s",
+    res += LOGIN_CREDENTIALS.pack(
         username.encode("utf8"),
         password.encode("utf8"),
     )
     return res
 
 
-def recv_full_size(sock: ssl.SSLSocket, size: int) -> bytes:
-    data = b""
+def recv_full_size(sock: ssl.SSLSocket, size: int) -> bytearray:
+    data = bytearray(size)
+    view = memoryview(data)
+    offset = 0
+
+    while offset != size:
+        received = sock.recv_into(view[offset:])
 
-    while len(data) != size:
-        frame = sock.read(len=(size - len(data)))
+        if received == 0:
+            raise ConnectionError("Connection closed by the printer")
 
-        data += frame
+        offset += received
 
     return data
 
 
+def write_frame(frame: bytearray):
+    # Write straight to stdout without going through Python buffering (and its extra copy and flush).
+    view = memoryview(frame)
+
+    while view:
+        written = os.write(sys.stdout.fileno(), view)
+        view = view[written:]
+
+
 def handle_packets(sock: ssl.SSLSocket):
-    data = recv_full_size(sock, 0x10)
-    (data_size, unk1, unk2, unk3) = struct.unpack("IIII", data)
+    data = recv_full_size(sock, PACKET_HEADER.size)
+    (data_size, unk1, unk2, unk3) = PACKET_HEADER.unpack_from(data)
 
     frame = recv_full_size(sock, data_size)
-    sys.stdout.buffer.write(frame)
-    sys.stdout.buffer.flush()
+    write_frame(frame)
 
 
 parser = argparse.ArgumentParser(
@@ -71,6 +87,10 @@ parser.add_argument("password")
 
 args = parser.parse_args()
 
+# Exit quietly when whatever reads the stream goes away.
+if hasattr(signal, "SIGPIPE"):
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
 with socket.create_connection((args.host, 6000)) as sock:
     with context.wrap_socket(sock) as ssock:
         ssock.write(generate_login_packet(args.username, args.password))